@@ -21,17 +21,22 @@
 import logging
 import os
 import sys
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+from typing import List
 from typing import Optional
-from typing import Set
+from typing import Tuple
 
-import attr
 import click
+import numpy as np
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import inspect
 from sqlalchemy import Column
 from sqlalchemy import Integer
 from sqlalchemy import Float
 from sqlalchemy import String
+from sqlalchemy import text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.session import Session
 from sqlalchemy.orm import sessionmaker
@@ -50,9 +55,25 @@ init_logging()
 _BUCKET_LARGE_SIZE = 3
 _BUCKET_MEDIUM_SIZE = 2
 _BUCKET_SMALL_SIZE = 1
+_COMMIT_BATCH_SIZE = 1000
 _DISCOUNT_FACTOR = 100
 _LOGGER = logging.getLogger("thoth.graph_estimator")
 _RESOURCE_HUNGRY_RECOMMENDATION_TYPES = frozenset({"stable", "performance", "security", "testing"})
+_SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+_SELECT_VERSION_COUNTS = text("SELECT package_name, version_count FROM package")
+_UPDATE_LOG_SUBGRAPH_SIZE = text(
+    "UPDATE package SET log_subgraph_size = :log_subgraph_size WHERE package_name = :package_name"
+)
+_UPSERT_VERSION_COUNT = text(
+    "INSERT INTO package (package_name, version_count) VALUES (:package_name, :version_count) "
+    "ON CONFLICT (package_name) DO UPDATE SET version_count = excluded.version_count"
+)
 
 _ModelBase = declarative_base()
 
@@ -62,27 +83,16 @@ class Package(_ModelBase):
 
     __tablename__ = 'package'
 
-    id = Column(Integer, primary_key=True)
-    package_name = Column(String)
+    package_name = Column(String, primary_key=True)
     version_count = Column(Integer)
-    subgraph_size = Column(Float)
+    # Natural logarithm of the subgraph size, the size itself overflows floats on large dependency graphs.
+    log_subgraph_size = Column(Float)
 
     def __repr__(self):
         """Representation of self."""
         return f'Package {self.package_name}'
 
 
-@attr.s(slots=True)
-class SubGraphEntity:
-    """A class representing a subgraph that needs to be checked."""
-
-    subgraph_name = attr.ib(type=str, init=True)
-
-    subgraphs_seen = attr.ib(type=Set[str], factory=set)
-    to_visit = attr.ib(type=Set[str], factory=set)
-    subgraph_size = attr.ib(type=float, default=1.0)
-
-
 def _print_version(ctx: click.Context, _, value: str):
     """Print graph estimator version and exit."""
     if not value or ctx.resilient_parsing:
@@ -92,76 +102,179 @@ def _print_version(ctx: click.Context, _, value: str):
     ctx.exit()
 
 
-def _get_session(database_path: str) -> Session:
+def _get_session(database_path: str, echo: bool = False) -> Session:
     """Create a database."""
-    engine = create_engine(f"sqlite:///{database_path}", echo=True)
+    engine = create_engine(f"sqlite:///{database_path}", echo=echo)
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, _) -> None:
+        """Tune SQLite for bulk writes on each new connection."""
+        cursor = dbapi_connection.cursor()
+        for pragma in _SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
     _ModelBase.metadata.create_all(engine)
+
+    # create_all() keeps tables created by older versions untouched, refuse them before any remote query is made.
+    inspector = inspect(engine)
+    columns = {column["name"] for column in inspector.get_columns(Package.__tablename__)}
+    primary_key = inspector.get_pk_constraint(Package.__tablename__)["constrained_columns"]
+    if columns != set(Package.__table__.columns.keys()) or primary_key != ["package_name"]:
+        raise click.ClickException(
+            f"Database {database_path!r} was created by an incompatible version of graph estimator, "
+            "recreate it using --recreate"
+        )
+
     Session = sessionmaker(bind=engine)
     return Session()
 
 
-def _fill_version_count(graph: GraphDatabase, session: Session) -> None:
-    """Compute number of versions stored in the database for each package."""
-    _LOGGER.info("Checking number of versions for each package")
+def _get_package_versions_count_all(graph: GraphDatabase, package_names: List[str], workers: int) -> Dict[str, int]:
+    """Retrieve number of versions for the given packages concurrently."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(package_names, executor.map(graph.get_package_versions_count_all, package_names)))
 
-    for package_name in graph.get_python_package_version_names_all(distinct=True):
-        version_count = graph.get_package_versions_count_all(package_name)
-        entry = session.query(Package).filter(Package.package_name == package_name).first()
-        if not entry:
-            entry = Package(package_name=package_name)
 
-        entry.version_count = version_count
-        session.add(entry)
-        session.commit()
+def _get_depends_on_package_names(graph: GraphDatabase, package_names: List[str], workers: int) -> Dict[str, List[str]]:
+    """Retrieve dependencies of the given packages concurrently."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(package_names, executor.map(graph.get_depends_on_package_names, package_names)))
 
 
-def _fill_graph_score(graph: GraphDatabase, session: Session) -> None:
-    """Compute and fill in graph score per each package."""
-    _LOGGER.info("Computing graph score for each package")
+def _fill_version_count(graph: GraphDatabase, session: Session, package_names: List[str], workers: int) -> None:
+    """Compute number of versions stored in the database for each package."""
+    _LOGGER.info("Checking number of versions for each package")
+
+    version_counts = _get_package_versions_count_all(graph, package_names, workers)
 
-    subgraphs = deque()
+    # Upsert rows in batches to avoid syncing the database file on each row. SQLAlchemy 1.3 has no SQLite specific
+    # insert construct, hence the raw statement executed for multiple rows at once.
+    rows = [{"package_name": name, "version_count": count} for name, count in version_counts.items()]
+    for idx in range(0, len(rows), _COMMIT_BATCH_SIZE):
+        session.execute(_UPSERT_VERSION_COUNT, rows[idx : idx + _COMMIT_BATCH_SIZE])
+        session.commit()
 
-    # The very first walk will mark down libraries that do not have any dependencies.
-    for package_name in graph.get_python_package_version_names_all(distinct=True):
-        dependencies = graph.get_depends_on_package_names(package_name)
-        subgraphs.append(SubGraphEntity(subgraph_name=package_name, to_visit=set(dependencies)))
-        if not dependencies:
-            entry = session.query(Package).filter(Package.package_name == package_name).first()
-            if not entry:
-                # Might be ingesting in the mean time, do not mark down and continue.
-                continue
 
-            entry.subgraph_size = entry.version_count
-            session.commit()
+def _gather_rows(indptr: np.ndarray, indices: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Concatenate the given rows of an adjacency matrix stored in the CSR layout."""
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    # Shift each output position of a row by the row start minus the row's offset in the output.
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return indices[offsets + np.arange(offsets.size)]
+
+
+def _sort_subgraphs(indptr: np.ndarray, indices: np.ndarray, unresolved: np.ndarray) -> List[np.ndarray]:
+    """Sort subgraphs into levels in topological order (Kahn's algorithm), return subgraph ids on each level.
+
+    A subgraph is placed on a level once all its dependencies are placed on the previous levels. Subgraphs with
+    unresolved dependencies or dependencies forming a cycle are not placed on any level.
+    """
+    subgraph_count = indptr.size - 1
+    unresolved = unresolved.copy()
+
+    # Reverse dependency index, dependents of subgraph i are dependents[dependents_indptr[i]:dependents_indptr[i + 1]].
+    dependents = np.repeat(np.arange(subgraph_count), np.diff(indptr))[np.argsort(indices, kind="stable")]
+    dependents_indptr = np.zeros(subgraph_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=subgraph_count), out=dependents_indptr[1:])
+
+    levels = []
+    level = np.flatnonzero(unresolved == 0)
+    while level.size:
+        levels.append(level)
+        level_dependents = _gather_rows(dependents_indptr, dependents, level)
+        np.subtract.at(unresolved, level_dependents, 1)  # Unbuffered, counts repeated dependents.
+        level_dependents = np.unique(level_dependents)
+        level = level_dependents[unresolved[level_dependents] == 0]
+
+    return levels
+
+
+def _compute_subgraph_sizes(
+    levels: List[np.ndarray], indptr: np.ndarray, indices: np.ndarray, log_version_counts: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Compute logarithm of subgraph sizes level by level, return subgraph ids and their sizes."""
+    order = np.concatenate(levels) if levels else np.empty(0, dtype=np.int64)
+
+    # Renumber subgraphs level by level so that dependencies of all the subgraphs on a level form a contiguous slice.
+    renumbered = np.empty(indptr.size - 1, dtype=np.int64)
+    renumbered[order] = np.arange(order.size)
+    level_indices = renumbered[_gather_rows(indptr, indices, order)]
+    level_indptr = np.zeros(order.size + 1, dtype=np.int64)
+    np.cumsum(np.diff(indptr)[order], out=level_indptr[1:])
+    log_version_counts = log_version_counts[order]
+
+    sizes = np.empty(order.size, dtype=np.float64)
+    start = 0
+    for level_idx, level in enumerate(levels):
+        end = start + level.size
+        if level_idx == 0:
+            # Libraries that do not have any dependencies.
+            sizes[start:end] = log_version_counts[start:end]
         else:
-            subgraphs.append(SubGraphEntity(subgraph_name=package_name, to_visit=set(dependencies)))
-
-    while subgraphs:
-        subgraph = subgraphs.popleft()
+            # Subgraphs past the first level have at least one known dependency, reduceat() sees no empty segment.
+            dependency_ids = level_indices[level_indptr[start] : level_indptr[end]]
+            sizes[start:end] = np.add.reduceat(
+                sizes[dependency_ids] + log_version_counts[dependency_ids],
+                level_indptr[start:end] - level_indptr[start],
+            )
 
-        for package_name in subgraph.to_visit:
-            entry = session.query(Package).filter(Package.package_name == package_name).first()
-            if not entry:
-                _LOGGER.warning("Cannot score subgraph %r as not all the dependencies were resolved", package_name)
-                break
+        start = end
 
-            if entry.subgraph_size is None:
-                # Scheduling for the next round.
-                subgraphs.append(subgraph)
-                break
+    return order, sizes
 
-            subgraph.subgraph_size *= entry.subgraph_size * entry.version_count
-            subgraph.subgraphs_seen.add(package_name)
-        else:
-            entry = session.query(Package).filter(Package.package_name == subgraph.subgraph_name).first()
-            if not entry:
-                _LOGGER.error("No subgraph for %r found, this looks like a programming error")
-                continue
 
-            entry.subgraph_size = subgraph.subgraph_size
-            session.commit()
+def _fill_graph_score(graph: GraphDatabase, session: Session, package_names: List[str], workers: int) -> None:
+    """Compute and fill in graph score per each package."""
+    _LOGGER.info("Computing graph score for each package")
 
-        subgraph.to_visit -= subgraph.subgraphs_seen
+    # Load all the packages at once to avoid querying the database for each dependency.
+    version_counts = {}
+    for package_name, version_count in session.execute(_SELECT_VERSION_COUNTS):
+        if not version_count or version_count < 1:
+            # Logarithm of the size is not defined, the package and its dependents are left unscored.
+            _LOGGER.warning("Cannot score subgraph %r as no versions are known for it", package_name)
+            continue
+
+        version_counts[package_name] = version_count
+
+    # Packages not stored yet might be ingesting in the mean time, do not mark them down.
+    package_names = [package_name for package_name in package_names if package_name in version_counts]
+    package_dependencies = _get_depends_on_package_names(graph, package_names, workers)
+    subgraph_names = list(package_dependencies)
+    subgraph_ids = {name: idx for idx, name in enumerate(subgraph_names)}
+    dependencies = [set(package_dependencies[name]) for name in subgraph_names]
+
+    # Dependencies are stored in the CSR layout, dependencies of subgraph i are indices[indptr[i]:indptr[i + 1]].
+    # Dependencies not known are not stored, they are counted as unresolved so that the subgraph is never scored.
+    dependency_ids = [[subgraph_ids[name] for name in names if name in subgraph_ids] for names in dependencies]
+    indptr = np.zeros(len(subgraph_names) + 1, dtype=np.int64)
+    np.cumsum([len(ids) for ids in dependency_ids], out=indptr[1:])
+    indices = np.fromiter((idx for ids in dependency_ids for idx in ids), dtype=np.int64, count=indptr[-1])
+    unresolved = np.fromiter((len(names) for names in dependencies), dtype=np.int64, count=len(subgraph_names))
+    log_version_counts = np.log(
+        np.fromiter((version_counts[name] for name in subgraph_names), dtype=np.float64, count=len(subgraph_names))
+    )
+
+    levels = _sort_subgraphs(indptr, indices, unresolved)
+    scored_ids, subgraph_sizes = _compute_subgraph_sizes(levels, indptr, indices, log_version_counts)
+
+    unscored = np.ones(len(subgraph_names), dtype=bool)
+    unscored[scored_ids] = False
+    for idx in np.flatnonzero(unscored):
+        _LOGGER.warning(
+            "Cannot score subgraph %r as not all the dependencies were resolved or they form a cycle",
+            subgraph_names[idx],
+        )
+
+    rows = [
+        {"package_name": subgraph_names[idx], "log_subgraph_size": size}
+        for idx, size in zip(scored_ids.tolist(), subgraph_sizes.tolist())
+    ]
+    for idx in range(0, len(rows), _COMMIT_BATCH_SIZE):
+        session.execute(_UPDATE_LOG_SUBGRAPH_SIZE, rows[idx : idx + _COMMIT_BATCH_SIZE])
+        session.commit()
 
 
 @click.group()
@@ -206,7 +319,24 @@ def cli(ctx: Optional[click.Context] = None, verbose: bool = False):
     default=False,
     help="Recreate the database - remove old one and create a new fresh database.",
 )
-def pile(path: str, recreate: bool) -> None:
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    envvar="THOTH_GRAPH_ESTIMATOR_WORKERS",
+    default=15,
+    show_default=True,
+    metavar="INT",
+    help="Number of threads used to query the knowledge graph concurrently, "
+    "the knowledge graph client pools at most 15 connections.",
+)
+@click.option(
+    "--echo",
+    envvar="THOTH_GRAPH_ESTIMATOR_ECHO",
+    is_flag=True,
+    default=False,
+    help="Log all the SQL statements issued to the graph estimator output data file.",
+)
+def pile(path: str, recreate: bool, workers: int, echo: bool) -> None:
     """Pile a local cache for the dependency graph size estimation."""
     _LOGGER.info("Connecting to the database...")
     graph = GraphDatabase()
@@ -216,11 +346,16 @@ def pile(path: str, recreate: bool) -> None:
     if os.path.isfile(path) and recreate:
         _LOGGER.warning("Removing old database file %r", path)
         os.remove(path)
+        # Also remove WAL files left behind, they would be replayed into the new database otherwise.
+        for wal_file in (f"{path}-wal", f"{path}-shm"):
+            if os.path.isfile(wal_file):
+                os.remove(wal_file)
 
-    session = _get_session(path)
+    session = _get_session(path, echo=echo)
 
-    # _fill_version_count(graph, session)
-    _fill_graph_score(graph, session)
+    package_names = list(graph.get_python_package_version_names_all(distinct=True))
+    _fill_version_count(graph, session, package_names, workers)
+    _fill_graph_score(graph, session, package_names, workers)
 
 
 def _do_estimate(recommendation_type: str, pipfile: Pipfile) -> None:
@@ -243,22 +378,24 @@ def _do_estimate(recommendation_type: str, pipfile: Pipfile) -> None:
     required=True,
     metavar="PIPFILE",
     show_default=True,
-    help="Type of recommendation generated based on knowledge base.",
+    help="Path to Pipfile or Pipfile content stating direct dependencies of the application.",
 )
-def estimate(recommendation_type: str, pipfile: str) -> None:
+def estimate(recommendation_type: str, requirements: str) -> None:
     """Estimate how big the dependency graph would be."""
     if recommendation_type == "latest":
         sys.exit(_BUCKET_SMALL_SIZE)
-    elif recommendation_type in _RESOURCE_HUNGRY_RECOMMENDATION_TYPES:
-        if os.path.isfile(pipfile):
-            pipfile_instance = Pipfile.from_file(pipfile)
-        else:
-            pipfile_instance = Pipfile.from_string(pipfile)
 
-        _do_estimate(recommendation_type, pipfile_instance)
-    else:
+    if recommendation_type not in _RESOURCE_HUNGRY_RECOMMENDATION_TYPES:
         _LOGGER.error("Unknown recommendation type %r, assuming largest bucket size", recommendation_type)
         sys.exit(_BUCKET_LARGE_SIZE)
 
+    # Requirements are parsed only for recommendation types that need them for the estimation.
+    if os.path.isfile(requirements):
+        pipfile = Pipfile.from_file(requirements)
+    else:
+        pipfile = Pipfile.from_string(requirements)
+
+    _do_estimate(recommendation_type, pipfile)
+
 
 __name__ == "__main__" and cli()
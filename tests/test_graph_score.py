@@ -0,0 +1,133 @@
+# thoth-graph-estimator
+# Copyright(C) 2020 Fridolin Pokorny
+#
+# This program is free software: you can redistribute it and / or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Test computing graph score against a naive recursive reference."""
+
+import math
+import os
+import random
+import tempfile
+import unittest
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import app
+
+
+class _GraphDatabaseMock:
+    """A knowledge graph stub serving fixed dependencies and version counts."""
+
+    def __init__(self, dependencies: Dict[str, List[str]], version_counts: Dict[str, int]) -> None:
+        """Store the graph served."""
+        self.dependencies = dependencies
+        self.version_counts = version_counts
+
+    def get_depends_on_package_names(self, package_name: str) -> List[str]:
+        """Get dependencies of the given package."""
+        return self.dependencies[package_name]
+
+    def get_package_versions_count_all(self, package_name: str) -> int:
+        """Get number of versions of the given package."""
+        return self.version_counts[package_name]
+
+
+def _reference_size(
+    package_name: str,
+    dependencies: Dict[str, List[str]],
+    version_counts: Dict[str, int],
+    stack: frozenset = frozenset(),
+) -> Optional[float]:
+    """Compute subgraph size using the product formula, None if the subgraph cannot be scored."""
+    if package_name not in dependencies or package_name in stack or version_counts[package_name] < 1:
+        return None
+
+    if not dependencies[package_name]:
+        return float(version_counts[package_name])
+
+    size = 1.0
+    for dependency_name in set(dependencies[package_name]):
+        dependency_size = _reference_size(dependency_name, dependencies, version_counts, stack | {package_name})
+        if dependency_size is None:
+            return None
+
+        size *= dependency_size * version_counts[dependency_name]
+
+    return size
+
+
+class TestFillGraphScore(unittest.TestCase):
+    """Test computing and storing graph score for packages."""
+
+    def _check(self, dependencies: Dict[str, List[str]], version_counts: Dict[str, int]) -> None:
+        """Check stored scores match the reference for the given graph."""
+        graph = _GraphDatabaseMock(dependencies, version_counts)
+        package_names = list(dependencies)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            session = app._get_session(os.path.join(tmp_dir, "data.db"))
+            try:
+                app._fill_version_count(graph, session, package_names, workers=2)
+                app._fill_graph_score(graph, session, package_names, workers=2)
+                stored = dict(session.query(app.Package.package_name, app.Package.log_subgraph_size))
+            finally:
+                session.close()
+
+        for package_name in package_names:
+            expected = _reference_size(package_name, dependencies, version_counts)
+            if expected is None:
+                self.assertIsNone(stored[package_name], package_name)
+            else:
+                self.assertAlmostEqual(stored[package_name], math.log(expected), msg=package_name)
+
+    def test_empty(self) -> None:
+        """Test an empty graph."""
+        self._check({}, {})
+
+    def test_diamond(self) -> None:
+        """Test a graph with shared and duplicate dependencies."""
+        self._check(
+            {"a": ["b", "c", "c"], "b": ["d"], "c": ["d"], "d": [], "e": []}, {"a": 2, "b": 3, "c": 4, "d": 5, "e": 6},
+        )
+
+    def test_unknown_dependency(self) -> None:
+        """Test subgraphs with a dependency not stored are not scored."""
+        self._check({"a": ["b"], "b": ["unknown"], "c": []}, {"a": 1, "b": 2, "c": 3})
+
+    def test_cycle(self) -> None:
+        """Test subgraphs forming or depending on a cycle are not scored."""
+        self._check({"a": ["b"], "b": ["a"], "c": ["a"], "d": []}, {"a": 1, "b": 2, "c": 3, "d": 4})
+
+    def test_self_loop(self) -> None:
+        """Test a subgraph depending on itself is not scored."""
+        self._check({"a": ["a"], "b": ["c"], "c": []}, {"a": 2, "b": 3, "c": 4})
+
+    def test_no_versions(self) -> None:
+        """Test packages without any version and their dependents are not scored."""
+        self._check({"a": ["b"], "b": [], "c": []}, {"a": 2, "b": 0, "c": 3})
+
+    def test_random(self) -> None:
+        """Test random graphs with unknown dependencies and cycles."""
+        rnd = random.Random(42)
+        for _ in range(50):
+            package_names = [f"package-{idx}" for idx in range(rnd.randint(1, 30))]
+            dependencies = {
+                package_name: [rnd.choice(package_names + ["unknown"]) for _ in range(rnd.randint(0, 3))]
+                for package_name in package_names
+            }
+            version_counts = {package_name: rnd.randint(1, 5) for package_name in package_names}
+            with self.subTest(dependencies=dependencies, version_counts=version_counts):
+                self._check(dependencies, version_counts)